@@ -5,6 +5,9 @@
 
 """OpenDKIM charm."""
 
+import concurrent.futures
+import functools
+import hashlib
 import logging
 import subprocess  # nosec B404
 import time
@@ -15,10 +18,17 @@ from pathlib import Path
 import ops
 from charmlibs import snap
 from charms.grafana_agent.v0.cos_agent import COSAgentProvider
-from jinja2 import Environment, FileSystemLoader, select_autoescape
 
 import utils
-from state import OPENDKIM_MILTER_PORT, InvalidCharmConfigError, OpenDKIMConfig
+from state import (
+    OPENDKIM_KEYS_PATH,
+    OPENDKIM_MILTER_PORT,
+    InvalidCharmConfigError,
+    OpenDKIMConfig,
+)
+
+if typing.TYPE_CHECKING:
+    import jinja2
 
 
 class RestartStrategy(Enum):
@@ -34,8 +44,9 @@ logger = logging.getLogger(__name__)
 OPENDKIM_SNAP_NAME = "opendkim"
 OPENDKIM_CONFIG_TEMPLATE = Path("opendkim.conf.j2")
 OPENDKIM_CONFIG_PATH = Path("/var/snap/opendkim/current/etc/opendkim.conf")
-OPENDKIM_KEYS_PATH = Path("/var/snap/opendkim/current/etc/dkimkeys")
 OPENDKIM_USER = "opendkim"
+# opendkim.testkey queries DNS for every key, keep a stuck resolver from stalling the hook.
+OPENDKIM_TESTKEY_TIMEOUT = 30
 
 LOG_ROTATE_SYSLOG = Path("/etc/logrotate.d/rsyslog")
 LOG_RETENTION_DAYS = 120
@@ -45,6 +56,8 @@ MILTER_RELATION_NAME = "milter"
 
 COS_DIRPATH = Path("cos")
 
+TELEGRAF_SNAP_NAME = "telegraf"
+
 TELEGRAF_CONF_SRC = COS_DIRPATH / "telegraf/telegraf.conf"
 TELEGRAF_CONF_DST = Path("/var/snap/telegraf/current/telegraf.conf")
 
@@ -52,6 +65,8 @@ TELEGRAF_CONF_DST = Path("/var/snap/telegraf/current/telegraf.conf")
 class OpenDKIMCharm(ops.CharmBase):
     """Charm the service."""
 
+    _stored = ops.StoredState()
+
     def __init__(self, *args: typing.Any):
         """Construct.
 
@@ -59,12 +74,14 @@ class OpenDKIMCharm(ops.CharmBase):
             args: Arguments passed to the CharmBase parent constructor.
         """
         super().__init__(*args)
+        self._stored.set_default(config_digest="")
         self.framework.observe(self.on.install, self._install)
         self.framework.observe(self.on.upgrade_charm, self._install)
         self.framework.observe(self.on.config_changed, self._reconcile)
         self.framework.observe(self.on.secret_changed, self._reconcile)
-        self.framework.observe(self.on[MILTER_RELATION_NAME].relation_changed, self._reconcile)
-        self.framework.observe(self.on[MILTER_RELATION_NAME].relation_departed, self._reconcile)
+        milter_events = self.on[MILTER_RELATION_NAME]
+        for milter_event in (milter_events.relation_changed, milter_events.relation_departed):
+            self.framework.observe(milter_event, self._reconcile)
         self.unit.open_port("tcp", OPENDKIM_MILTER_PORT)
 
         self._grafana_agent = COSAgentProvider(
@@ -80,9 +97,16 @@ class OpenDKIMCharm(ops.CharmBase):
     def _install(self, _: ops.EventBase) -> None:
         """Install opendkim snap and telegraf snap."""
         self.unit.status = ops.MaintenanceStatus("installing opendkim")
-        opendkim_installed = self._install_opendkim()
+        # A new charm revision may render the same config differently.
+        self._stored.config_digest = ""
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            # Compile the template while the snaps download, its bytecode cache is then
+            # ready for the first reconcile.
+            template_future = executor.submit(lambda: self._config_template)
+            opendkim_installed = self._install_opendkim()
 
-        self._install_telegraf()
+            self._install_telegraf()
+            template_future.result()
 
         rotate_content = utils.update_logrotate_conf(
             str(LOG_ROTATE_SYSLOG), frequency="daily", retention=LOG_RETENTION_DAYS
@@ -100,15 +124,10 @@ class OpenDKIMCharm(ops.CharmBase):
             True if the snap was installed successfully, False otherwise.
         """
         try:
-            result = subprocess.run(  # nosec B603
-                ["/usr/bin/snap", "list", OPENDKIM_SNAP_NAME],
-                capture_output=True,
-                text=True,
-            )
-            if result.returncode != 0:
-                opendkim_snap = self._get_opendkim_snap()
+            opendkim_snap = self._get_opendkim_snap()
+            if not opendkim_snap.present:
                 opendkim_snap.ensure(snap.SnapState.Latest, channel="stable")
-        except snap.SnapError:
+        except (snap.SnapError, snap.SnapNotFoundError):
             logger.exception("An exception occurred when installing OpenDKIM snap")
             self.unit.status = ops.BlockedStatus("Unable to install OpenDKIM snap")
             return False
@@ -125,19 +144,33 @@ class OpenDKIMCharm(ops.CharmBase):
         return cache[OPENDKIM_SNAP_NAME]
 
     def _install_telegraf(self) -> None:
-        """Install telegraf."""
+        """Install telegraf and restart it if it was installed or its configuration changed."""
         try:
-            telegraf_snap = typing.cast(snap.Snap, snap.add(["telegraf"]))
+            telegraf_snap = snap.SnapCache()[TELEGRAF_SNAP_NAME]
+            installed = not telegraf_snap.present
+            if installed:
+                telegraf_snap.ensure(snap.SnapState.Latest)
             TELEGRAF_CONF_DST.touch()
-            utils.write_file(TELEGRAF_CONF_DST, TELEGRAF_CONF_SRC.read_text(), 0o644, user="root")
-            telegraf_snap.restart()
-        except snap.SnapError:
+            conf_updated = utils.write_file(
+                TELEGRAF_CONF_DST, TELEGRAF_CONF_SRC.read_bytes(), 0o644, user="root"
+            )
+            if installed or conf_updated:
+                telegraf_snap.restart()
+        except (snap.SnapError, snap.SnapNotFoundError):
             logger.exception("An exception occurred when installing Telegraf snap")
 
-    def _reconcile(self, _: ops.EventBase) -> None:
-        """Configure the workload with the provided configuration for the charm."""
+    def _reconcile(self, event: ops.EventBase) -> None:
+        """Configure the workload with the provided configuration for the charm.
+
+        Args:
+            event: The event that triggered the reconcile.
+        """
         try:
-            config = OpenDKIMConfig.from_charm(self.config, self.model)
+            config = OpenDKIMConfig.from_charm(
+                self.config,
+                self.model,
+                refresh_secret=isinstance(event, ops.SecretChangedEvent),
+            )
         except InvalidCharmConfigError as exc:
             logger.exception("Error validating the charm configuration.")
             self.unit.status = ops.BlockedStatus(str(exc))
@@ -150,6 +183,14 @@ class OpenDKIMCharm(ops.CharmBase):
         for milter_relation in milter_relations:
             milter_relation.data[self.model.unit]["port"] = str(OPENDKIM_MILTER_PORT)
 
+        config_digest = hashlib.blake2b(config.model_dump_json().encode()).hexdigest()
+        if config_digest == self._stored.config_digest:
+            logger.info("Configuration unchanged since the last successful reconcile")
+            self.unit.status = ops.ActiveStatus()
+            return
+        # Only a fully validated configuration can be skipped next time.
+        self._stored.config_digest = ""
+
         should_restart = self._write_config_files(config)
 
         if not self._validate_keytable_keys(config):
@@ -164,10 +205,11 @@ class OpenDKIMCharm(ops.CharmBase):
             logger.exception("Invalid opendkim configuration")
             self.unit.status = ops.BlockedStatus(str(exc))
             return
+        self._stored.config_digest = config_digest
         self.unit.status = ops.ActiveStatus()
 
     def _write_config_files(self, config: OpenDKIMConfig) -> RestartStrategy:
-        """Write all configuration files, comparing content to avoid unnecessary writes.
+        """Write all configuration files, leaving files with unchanged content untouched.
 
         Args:
             config: The validated OpenDKIM configuration.
@@ -177,38 +219,29 @@ class OpenDKIMCharm(ops.CharmBase):
             changed, or RESTART if the main config changed.
         """
         needs_config = False
-        needs_keys = False
-
-        for keyname, keyvalue in config.private_keys.items():
-            keyfile = OPENDKIM_KEYS_PATH / f"{keyname}.private"
-            if keyvalue != utils.read_text(keyfile):
-                utils.write_file(keyfile, keyvalue, 0o600, user=OPENDKIM_USER)
-                needs_keys = True
-
-        signingtable_path = OPENDKIM_KEYS_PATH / config.signingtable_path.name
-        signingtable = "\n".join(" ".join(row) for row in config.signingtable)
-        if signingtable != utils.read_text(signingtable_path):
-            utils.write_file(signingtable_path, signingtable, 0o644, user=OPENDKIM_USER)
-            needs_keys = True
-
-        keytable_path = OPENDKIM_KEYS_PATH / config.keytable_path.name
-        keytable = "\n".join(" ".join(row) for row in config.keytable)
-        if keytable != utils.read_text(keytable_path):
-            utils.write_file(keytable_path, keytable, 0o644, user=OPENDKIM_USER)
-            needs_keys = True
+
+        key_files: list[tuple[Path, str | bytes, int]] = [
+            (OPENDKIM_KEYS_PATH / f"{keyname}.private", keyvalue, 0o600)
+            for keyname, keyvalue in config.private_keys.items()
+        ]
+        key_files.append(
+            (OPENDKIM_KEYS_PATH / config.signingtable_path.name, config.signingtable_text, 0o644)
+        )
+        key_files.append(
+            (OPENDKIM_KEYS_PATH / config.keytable_path.name, config.keytable_text, 0o644)
+        )
+        needs_keys = utils.write_files(key_files, user=OPENDKIM_USER)
 
         if config.trusted_sources:
             internalhosts_content = "\n".join(config.trusted_sources)
             internalhosts_path = OPENDKIM_KEYS_PATH / "internalhosts"
-            if internalhosts_content != utils.read_text(internalhosts_path):
-                utils.write_file(
-                    internalhosts_path, internalhosts_content, 0o644, user=OPENDKIM_USER
-                )
+            if utils.write_file(
+                internalhosts_path, internalhosts_content, 0o644, user=OPENDKIM_USER
+            ):
                 needs_config = True
 
         rendered = self._render_opendkim_conf(config)
-        if rendered != utils.read_text(OPENDKIM_CONFIG_PATH):
-            utils.write_file(OPENDKIM_CONFIG_PATH, rendered, 0o644, user=OPENDKIM_USER)
+        if utils.write_file(OPENDKIM_CONFIG_PATH, rendered, 0o644, user=OPENDKIM_USER):
             needs_config = True
 
         if needs_config:
@@ -217,8 +250,34 @@ class OpenDKIMCharm(ops.CharmBase):
             return RestartStrategy.RELOAD
         return RestartStrategy.NONE
 
-    @staticmethod
-    def _render_opendkim_conf(config: OpenDKIMConfig) -> str:
+    @functools.cached_property
+    def _jinja_env(self) -> "jinja2.Environment":
+        """Return the Jinja environment, built on first use and kept for the hook.
+
+        jinja2 is only imported here, so hooks that never render a template do not
+        pay for importing it. The bytecode cache persists the compiled templates
+        across hook processes. Its default directory is a per-user 0700 directory
+        under the system temp dir.
+        """
+        import jinja2
+
+        return jinja2.Environment(
+            loader=jinja2.FileSystemLoader("templates"),
+            bytecode_cache=jinja2.FileSystemBytecodeCache(),
+            autoescape=jinja2.select_autoescape(),
+            # The template cannot change during a hook, do not stat it on each lookup.
+            auto_reload=False,
+            keep_trailing_newline=True,
+            trim_blocks=True,
+            lstrip_blocks=True,
+        )
+
+    @functools.cached_property
+    def _config_template(self) -> "jinja2.Template":
+        """Return the compiled opendkim.conf template."""
+        return self._jinja_env.get_template(str(OPENDKIM_CONFIG_TEMPLATE))
+
+    def _render_opendkim_conf(self, config: OpenDKIMConfig) -> str:
         """Render the opendkim.conf template.
 
         Args:
@@ -227,16 +286,9 @@ class OpenDKIMCharm(ops.CharmBase):
         Returns:
             The rendered configuration string.
         """
-        context = config.model_dump()
-        env = Environment(
-            loader=FileSystemLoader("templates"),
-            autoescape=select_autoescape(),
-            keep_trailing_newline=True,
-            trim_blocks=True,
-            lstrip_blocks=True,
-        )
-        template = env.get_template(str(OPENDKIM_CONFIG_TEMPLATE))
-        return template.render(context)
+        # The template reads the model attributes directly: a model_dump() would copy
+        # every field, including the private keys and both tables.
+        return self._config_template.render(config=config)
 
     def _validate_keytable_keys(self, config: OpenDKIMConfig) -> bool:
         """Validate that all key files referenced in the keytable exist.
@@ -334,10 +386,10 @@ def validate_opendkim() -> None:
     try:
         subprocess.run(  # nosec
             ["opendkim.testkey", "-x", str(OPENDKIM_CONFIG_PATH), "-vv"],
-            timeout=100,
+            timeout=OPENDKIM_TESTKEY_TIMEOUT,
             check=True,
         )
-    except (subprocess.CalledProcessError, TimeoutError) as exc:
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as exc:
         logger.exception("Error validating with opendkim.testkey")
         raise InvalidCharmConfigError("Wrong opendkim configuration. See logs") from exc
 
@@ -3,16 +3,20 @@
 
 """OpenDKIM state."""
 
+import functools
 import logging
 import typing
 from pathlib import Path
 
 import ops
 import yaml
-from pydantic import BaseModel, ValidationError, computed_field
+from pydantic import BaseModel, ConfigDict, TypeAdapter, ValidationError, computed_field
 
 logger = logging.getLogger(__name__)
 
+if not yaml.__with_libyaml__:  # pragma: no cover
+    logger.warning("libyaml is not available, using the slower pure Python YAML loader")
+
 OPENDKIM_MILTER_PORT = 8892
 OPENDKIM_KEYS_PATH = Path("/var/snap/opendkim/current/etc/dkimkeys")
 OPENDKIM_SIGNINGTABLE_PATH = OPENDKIM_KEYS_PATH / "signingtable"
@@ -27,6 +31,11 @@ DEFAULT_SIGN_HEADERS = (
     ",MIME-Version,Message-ID,Content-Type"
 )
 
+# Only the tables are parsed from user YAML and need validating: secret content is always
+# a str to str mapping and trusted_sources comes from _parse_trusted_sources.
+_SIGNINGTABLE_ADAPTER = TypeAdapter(list[typing.Tuple[str, str]])
+_KEYTABLE_ADAPTER = TypeAdapter(list[list[str]])
+
 
 class InvalidCharmConfigError(Exception):
     """Exception raised when the parsed charm config is invalid."""
@@ -49,8 +58,12 @@ class OpenDKIMConfig(BaseModel):
         verify_mode: True if in verify model.
         signingtable_path: Path to the signingtable file.
         keytable_path:  to the keytable file.
+        signingtable_text: Content of the signingtable file.
+        keytable_text: Content of the keytable file.
     """
 
+    model_config = ConfigDict(frozen=True, extra="ignore")
+
     canonicalization: str = "relaxed/relaxed"
     socket: str = f"inet:{OPENDKIM_MILTER_PORT}"
     signheaders: str = DEFAULT_SIGN_HEADERS
@@ -75,13 +88,29 @@ class OpenDKIMConfig(BaseModel):
         """Return True if the charm works in verify mode."""
         return "v" in self.mode
 
+    @computed_field  # type: ignore[prop-decorator]
+    @functools.cached_property
+    def signingtable_text(self) -> str:
+        """Return the content of the signingtable file."""
+        return "\n".join(f"{pattern} {key}" for pattern, key in self.signingtable)
+
+    @computed_field  # type: ignore[prop-decorator]
+    @functools.cached_property
+    def keytable_text(self) -> str:
+        """Return the content of the keytable file."""
+        return "\n".join(" ".join(row) for row in self.keytable)
+
     @classmethod
-    def from_charm(cls, config: ops.model.ConfigData, model: ops.model.Model) -> typing.Self:
+    def from_charm(
+        cls, config: ops.model.ConfigData, model: ops.model.Model, refresh_secret: bool = True
+    ) -> typing.Self:
         """Return a new OpenDKIM configuration from the OpenDKIMCharm config and model.
 
         Args:
           config: Config options from the charm.
           model: Model for the charm.
+          refresh_secret: Track the latest revision of the private keys secret, instead of
+            reading the revision the unit already tracks.
 
         Raises:
           InvalidCharmConfigError: When the configuration from the charm is not valid.
@@ -114,19 +143,32 @@ class OpenDKIMConfig(BaseModel):
 
         secret = model.get_secret(id=typing.cast(str, private_keys_secret_id))
 
-        private_keys = secret.get_content(refresh=True)
+        private_keys = secret.get_content(refresh=refresh_secret)
+
+        invalid_fields = []
+        try:
+            signingtable = _SIGNINGTABLE_ADAPTER.validate_python(signingtable)
+        except ValidationError as exc:
+            logger.error(str(exc))
+            invalid_fields.extend(get_invalid_config_fields(exc, "signingtable"))
         try:
-            return cls(
-                signingtable=signingtable,
-                keytable=keytable,
-                private_keys=private_keys,
-                mode=mode,
-                trusted_sources=trusted_sources,
-            )
+            keytable = _KEYTABLE_ADAPTER.validate_python(keytable)
         except ValidationError as exc:
             logger.error(str(exc))
-            error_field_str = ",".join(f"{field}" for field in get_invalid_config_fields(exc))
-            raise InvalidCharmConfigError(f"wrong config options: {error_field_str}.") from exc
+            invalid_fields.extend(get_invalid_config_fields(exc, "keytable"))
+
+        if invalid_fields:
+            error_field_str = ",".join(invalid_fields)
+            raise InvalidCharmConfigError(f"wrong config options: {error_field_str}.")
+
+        # Every field has been validated, so skip validating the whole model again.
+        return cls.model_construct(
+            signingtable=signingtable,
+            keytable=keytable,
+            private_keys=private_keys,
+            mode=mode,
+            trusted_sources=trusted_sources,
+        )
 
 
 def _parse_yaml_config_option(config_data: ops.model.ConfigData, config_name: str) -> typing.Any:
@@ -134,8 +176,19 @@ def _parse_yaml_config_option(config_data: ops.model.ConfigData, config_name: st
     config_value = typing.cast(typing.Optional[str], config_data.get(config_name))
     if not config_value:
         raise ValueError(f"empty {config_name} configuration")
+    return _load_yaml_config_option(config_name, config_value)
+
+
+@functools.lru_cache(maxsize=16)
+def _load_yaml_config_option(config_name: str, config_value: str) -> typing.Any:
+    """Return the parsed YAML of a configuration option value.
+
+    The result is cached per raw value and shared between callers, so it must not be mutated.
+    """
     try:
-        return yaml.safe_load(config_value)
+        if yaml.__with_libyaml__:
+            return yaml.load(config_value, Loader=yaml.CSafeLoader)
+        return yaml.safe_load(config_value)  # pragma: no cover
     except yaml.YAMLError as exc:
         logger.exception("Failed loading %s", config_name)
         raise ValueError(f"wrong {config_name} format") from exc
@@ -155,15 +208,18 @@ def _parse_trusted_sources(raw_value: typing.Optional[str]) -> list[str]:
     return [entry.strip() for entry in raw_value.split(",") if entry.strip()]
 
 
-def get_invalid_config_fields(exc: ValidationError) -> list[str]:
+def get_invalid_config_fields(exc: ValidationError, field_name: str | None = None) -> list[str]:
     """Return a list on invalid config from pydantic validation error.
 
     Args:
         exc: The validation error exception.
+        field_name: Name of the validated field, when the error comes from a TypeAdapter.
 
     Returns:
         str: list of fields that failed validation.
     """
-    logger.info(exc.errors())
-    error_fields = ["-".join([str(i) for i in error["loc"]]) for error in exc.errors()]
-    return error_fields
+    errors = exc.errors()
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(errors)
+    prefix = (field_name,) if field_name else ()
+    return ["-".join(map(str, (*prefix, *error["loc"]))) for error in errors]
@@ -3,11 +3,17 @@
 
 """OpenDKIM charm utils."""
 
+import functools
 import os
 import pwd
 import re
+import stat
+import tempfile
+from collections.abc import Callable, Iterable
 from pathlib import Path
 
+_LOGROTATE_RE = re.compile(r"^(\s+)(daily|weekly|monthly|rotate|dateext)")
+
 
 def update_logrotate_conf(
     path: Path, frequency: str | None = None, retention: int = 0, dateext: bool = True
@@ -26,66 +32,172 @@ def update_logrotate_conf(
     if not os.path.exists(path):
         return ""
 
+    handlers = _logrotate_handlers(frequency, retention, dateext)
+    new: list[str] = []
     with open(path, encoding="utf-8") as f:
-        config = f.read().split("\n")
-
-    new = []
-    regex = re.compile("^(\\s+)(daily|weekly|monthly|rotate|dateext)")
-    for line in config:
-        m = regex.match(line)
-        if not m:
-            new.append(line)
-            continue
-
-        conf = m.group(2)
-        indent = m.group(1)
-
-        # Rotation frequency.
-        if frequency and conf in ("daily", "weekly", "monthly"):
-            new.append(f"{indent}{frequency}")
-        elif retention and conf == "dateext":
-            # Ignore 'dateext', we'll put it back on updating 'rotate'.
-            continue
-        elif retention and conf == "rotate":
-            if dateext:
-                new.append(f"{indent}dateext")
-            new.append(f"{indent}rotate {retention}")
-        else:
-            new.append(line)
-
-    return "\n".join(new)
-
-
-def read_text(path: Path) -> str:
-    """Return text from a file.
+        # Lines keep their newline, so the file is rebuilt with a single join.
+        for line in f:
+            m = _LOGROTATE_RE.match(line)
+            handler = handlers.get(m.group(2)) if m else None
+            if m is None or handler is None:
+                new.append(line)
+                continue
+            new.extend(handler(m.group(1), "\n" if line.endswith("\n") else ""))
+
+    return "".join(new)
+
+
+def _logrotate_handlers(
+    frequency: str | None, retention: int, dateext: bool
+) -> dict[str, Callable[[str, str], list[str]]]:
+    """Return the functions rewriting a logrotate directive, by directive name.
+
+    Each function takes the indentation and the newline of the directive line and
+    returns the lines replacing it. Directives without a function are kept as is.
+    """
+    handlers: dict[str, Callable[[str, str], list[str]]] = {}
+    # Rotation frequency.
+    if frequency:
+        handlers.update(
+            dict.fromkeys(
+                ("daily", "weekly", "monthly"),
+                lambda indent, eol: [f"{indent}{frequency}{eol}"],
+            )
+        )
+    if retention:
+        # Ignore 'dateext', we'll put it back on updating 'rotate'.
+        handlers["dateext"] = lambda indent, eol: []
+        handlers["rotate"] = lambda indent, eol: [
+            *([f"{indent}dateext\n"] if dateext else []),
+            f"{indent}rotate {retention}{eol}",
+        ]
+    return handlers
+
+
+def file_matches(path: Path, content: str | bytes) -> bool:
+    """Return whether a file already holds the given content.
+
+    The file size is compared first, so most changes are detected without
+    reading the file.
 
     Args:
-        path: Path of the file ro read.
+        path: Path of the file to compare.
+        content: The expected content of the file, text is encoded as UTF-8.
 
-    Returns: String content of the file.
+    Returns:
+        True if the file exists and its content is equal to the given content.
     """
+    encoded = content.encode("utf-8") if isinstance(content, str) else content
     try:
-        return path.read_text()
+        if path.stat().st_size != len(encoded):
+            return False
+        return path.read_bytes() == encoded
     except FileNotFoundError:
-        return ""
+        return False
+
 
+@functools.lru_cache(maxsize=8)
+def _get_user_ids(user: str) -> tuple[int, int]:
+    """Return the uid and gid of a user, looking it up once per process.
 
-def write_file(path: Path, content: str, mode: int, user: str) -> None:
+    Failed lookups raise KeyError and are not cached.
+    """
+    u = pwd.getpwnam(user)
+    return u.pw_uid, u.pw_gid
+
+
+def _fix_permissions(path: Path, mode: int, uid: int, gid: int) -> None:
+    """Apply the mode and owner to an existing file, only where they differ."""
+    st = path.stat()
+    if stat.S_IMODE(st.st_mode) != mode:
+        os.chmod(path, mode)
+    if (st.st_uid, st.st_gid) != (uid, gid):
+        os.chown(path, uid=uid, gid=gid)
+
+
+def write_file(
+    path: Path,
+    content: str | bytes,
+    mode: int,
+    user: str,
+    only_if_changed: bool = True,
+    sync_dir: bool = True,
+) -> bool:
     """Write a content rendered from a template to a file.
 
+    The content is written to a temporary file in the same directory, which already
+    has the final mode and owner, synced to disk and then renamed over the target.
+    Readers never see a partially written file or one with the wrong permissions.
+
     Args:
         path: Path object to the file.
-        content: the data to be written to the file.
+        content: the data to be written to the file, text is encoded as UTF-8.
         mode: access permission mask applied to the
             file using chmod (e.g. 0o640).
         user: The user that will own the file.
+        only_if_changed: Leave the file content untouched if it already holds the content,
+            only fixing its mode and owner if needed.
+        sync_dir: Sync the directory after the rename, so the new file survives a crash.
+
+    Returns:
+        True if the file content was written.
     """
-    path.parent.mkdir(parents=True, exist_ok=True)
-    path.write_text(content, encoding="utf-8")
-    os.chmod(path, mode)
+    encoded = content.encode("utf-8") if isinstance(content, str) else content
     try:
-        u = pwd.getpwnam(user)
+        uid, gid = _get_user_ids(user)
     except KeyError:
         # Fallback to root if user does not exist (e.g., opendkim snap not yet installed).
-        u = pwd.getpwnam("root")
-    os.chown(path, uid=u.pw_uid, gid=u.pw_gid)
+        uid, gid = _get_user_ids("root")
+    if only_if_changed and file_matches(path, encoded):
+        _fix_permissions(path, mode, uid, gid)
+        return False
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # mkstemp creates a new file with a unique name, never following a symlink.
+    fd, tmp_name = tempfile.mkstemp(prefix=f".{path.name}.", suffix=".tmp", dir=path.parent)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            os.fchmod(f.fileno(), mode)
+            os.fchown(f.fileno(), uid, gid)
+            f.write(encoded)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_name, path)
+    except OSError:
+        Path(tmp_name).unlink(missing_ok=True)
+        raise
+    if sync_dir:
+        fsync_dir(path.parent)
+    return True
+
+
+def write_files(files: Iterable[tuple[Path, str | bytes, int]], user: str) -> bool:
+    """Write several files, then sync each directory holding a changed file once.
+
+    Args:
+        files: The path, content and mode of each file, as passed to write_file.
+        user: The user that will own the files.
+
+    Returns:
+        True if the content of any of the files was written.
+    """
+    changed_dirs = {
+        path.parent
+        for path, content, mode in files
+        if write_file(path, content, mode, user=user, sync_dir=False)
+    }
+    for directory in changed_dirs:
+        fsync_dir(directory)
+    return bool(changed_dirs)
+
+
+def fsync_dir(path: Path) -> None:
+    """Flush the entries of a directory, such as renamed files, to disk.
+
+    Args:
+        path: Path of the directory.
+    """
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
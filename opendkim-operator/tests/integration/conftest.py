@@ -14,6 +14,8 @@ import pytest
 logger = logging.getLogger(__name__)
 
 OPENDKIM_SNAP_DIR = pathlib.Path(__file__).resolve().parents[3] / "opendkim-snap"
+# Domain of the test messages, smtp-relay relays it to mailcatcher.
+RELAY_DOMAIN = "testrelay.internal"
 
 
 @pytest.fixture(scope="module", name="opendkim_charm")
@@ -109,11 +111,14 @@ def deploy_smtp_relay_fixture(
     opendkim_app: str,
     juju: jubilant.Juju,
 ) -> str:
-    """Deploy smtp-relay and integrate with dkim."""
+    """Deploy smtp-relay, relaying the test domain, and integrate with dkim."""
     smtp_relay_app_name = "smtp-relay"
+    relay_config = {"relay_domains": f"- {RELAY_DOMAIN}"}
 
-    if not juju.status().apps.get(smtp_relay_app_name):
-        juju.deploy(smtp_relay_app_name, smtp_relay_app_name)
+    if juju.status().apps.get(smtp_relay_app_name):
+        juju.config(smtp_relay_app_name, relay_config)
+    else:
+        juju.deploy(smtp_relay_app_name, smtp_relay_app_name, config=relay_config)
         juju.integrate(smtp_relay_app_name, opendkim_app)
         juju.wait(
             lambda status: (
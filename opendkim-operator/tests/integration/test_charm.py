@@ -7,26 +7,34 @@
 
 # pylint: disable=too-many-arguments,too-many-locals
 
+import base64
 import json
 import logging
-import pathlib
+import os
+import random
 import smtplib
 import socket
-import subprocess  # nosec B404
-import tempfile
 import time
 import typing
 
 import jubilant
 import pytest
 import requests
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
 
 logger = logging.getLogger(__name__)
 
+DKIM_DOMAIN = "testrelay.internal"
+DKIM_SELECTOR = "default"
+DKIM_KEYNAME = "testrelay-internal-default"
+
 
 def generate_opendkim_genkey(domain: str, selector: str) -> typing.Tuple[str, str]:
     """Generate dkim txt record and private key for a domain an selector.
 
+    The key and record are generated in process, in the same formats as opendkim-genkey.
+
     Args:
         domain: Domain for the key.
         selector: dkim selector for the key.
@@ -34,85 +42,179 @@ def generate_opendkim_genkey(domain: str, selector: str) -> typing.Tuple[str, st
     Returns:
         The txt record and the private key.
     """
-    with tempfile.TemporaryDirectory(dir=pathlib.Path.home()) as tmpdirname:
-        subprocess.run(  # nosec
-            ["opendkim-genkey", "-s", selector, "-d", domain],
-            check=True,
-            cwd=tmpdirname,
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    private_data = key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.TraditionalOpenSSL,
+        encryption_algorithm=serialization.NoEncryption(),
+    ).decode()
+    public_key = base64.b64encode(
+        key.public_key().public_bytes(
+            encoding=serialization.Encoding.DER,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo,
         )
-        # Two files should have been created, {selector}.txt and {selector}.private
-        txt_data = (pathlib.Path(tmpdirname) / pathlib.Path(f"{selector}.txt")).read_text()
-        private_data = (pathlib.Path(tmpdirname) / pathlib.Path(f"{selector}.private")).read_text()
-        return txt_data, private_data
+    ).decode()
+    txt_data = (
+        f'{selector}._domainkey\tIN\tTXT\t( "v=DKIM1; h=sha256; k=rsa; s=email; p={public_key}" )'
+        f"  ; ----- DKIM key {selector} for {domain}\n"
+    )
+    return txt_data, private_data
 
 
-@pytest.fixture(scope="session", name="machine_ip_address")
-def machine_ip_address_fixture() -> str:
-    """IP address for the machine running the tests.
+def config_if_changed(juju: jubilant.Juju, app: str, values: dict[str, str]) -> bool:
+    """Set the application config options that differ from the given values.
+
+    Setting an option to its current value still costs a juju call, skip it.
+
+    Args:
+        juju: The Juju client.
+        app: The application name.
+        values: The config options to set.
 
     Returns:
-        The IP address of the current machine.
+        True if any config option was changed.
     """
-    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    s.connect(("8.8.8.8", 80))
-    ip_address = s.getsockname()[0]
-    logger.info("IP Address for the current test runner: %s", ip_address)
-    s.close()
-    return ip_address
+    current = juju.config(app)
+    changed = {key: value for key, value in values.items() if current.get(key) != value}
+    if changed:
+        juju.config(app, changed)
+    return bool(changed)
 
 
-@pytest.mark.abort_on_fail
-def test_opendkim_signed_message(
-    juju: jubilant.Juju, opendkim_app, smtp_relay_app, machine_ip_address
-):
+def send_message(
+    server: smtplib.SMTP, from_addr: str, to_addrs: list[str], subject: str, body: str
+) -> None:
+    """Send a plain text message through an open SMTP connection.
+
+    The connection is left open, so several messages can share its setup.
+
+    Args:
+        server: The connected SMTP client.
+        from_addr: The sender address.
+        to_addrs: The recipient addresses.
+        subject: The message subject.
+        body: The message body.
     """
-    arrange: Deploy smtp-relay charm with the testrelay.internal domain in relay domains.
-    act: Send an email to an address with the testrelay.internal domain.
-    assert: The email is correctly relayed to the mailcatcher local test smtp server.
+    message = f"Subject: {subject}\nTo: {', '.join(to_addrs)}\nFrom: {from_addr}\n{body}"
+    server.sendmail(from_addr=from_addr, to_addrs=to_addrs, msg=message)
+
+
+@pytest.fixture(scope="session", name="dkim_keypair")
+def dkim_keypair_fixture() -> typing.Tuple[str, str]:
+    """DKIM key for the test domain and selector, generated once for all the tests.
+
+    Returns:
+        The txt record and the private key.
     """
-    status = juju.status()
-    unit = next(iter(status.apps[smtp_relay_app].units.values()))
-    unit_ip = unit.public_address
+    return generate_opendkim_genkey(domain=DKIM_DOMAIN, selector=DKIM_SELECTOR)
 
-    domain = "testrelay.internal"
-    selector = "default"
-    keyname = "testrelay-internal-default"
-    _, private_key = generate_opendkim_genkey(domain=domain, selector=selector)
 
+@pytest.fixture(scope="module", name="opendkim_secret_id")
+def opendkim_secret_id_fixture(
+    juju: jubilant.Juju, opendkim_app: str, dkim_keypair: typing.Tuple[str, str]
+) -> str:
+    """Secret holding the DKIM private key, granted to opendkim once for all the tests.
+
+    Returns:
+        The secret ID.
+    """
+    _, private_key = dkim_keypair
     try:
-        secret_id = juju.add_secret("opendkimsecret", {f"{keyname}": private_key})
+        secret_id = juju.add_secret("opendkimsecret", {DKIM_KEYNAME: private_key})
     except jubilant.CLIError as e:
-        secret_info = juju.show_secret("opendkimsecret")
-        secret_id = secret_info.uri
         if "already exists" in e.stderr:
-            juju.update_secret(secret_id, {f"{keyname}": private_key})
+            secret_info = juju.show_secret("opendkimsecret")
+            secret_id = secret_info.uri
+            juju.update_secret(secret_id, {DKIM_KEYNAME: private_key})
         else:
             logger.error("Error adding secret %s %s", e.stderr, e.stdout)
             raise e
 
     juju.cli("grant-secret", secret_id, opendkim_app)
+    return secret_id
+
+
+@pytest.fixture(scope="session", name="machine_ip_address")
+def machine_ip_address_fixture() -> str:
+    """IP address for the machine running the tests.
+
+    The PYTEST_MACHINE_IP environment variable takes precedence over the detected address,
+    the host name address is used when there is no route to the internet.
+
+    Returns:
+        The IP address of the current machine.
+    """
+    if ip_address := os.environ.get("PYTEST_MACHINE_IP"):
+        return ip_address
+    try:
+        # Connecting a UDP socket sends nothing, it only picks the outbound interface.
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.settimeout(1.0)
+            s.connect(("8.8.8.8", 80))
+            ip_address = s.getsockname()[0]
+    except OSError:
+        ip_address = socket.gethostbyname(socket.gethostname())
+    logger.info("IP Address for the current test runner: %s", ip_address)
+    return ip_address
+
+
+@pytest.fixture(scope="module", name="configured_opendkim")
+def configured_opendkim_fixture(
+    juju: jubilant.Juju,
+    opendkim_app: str,
+    smtp_relay_app: str,
+    machine_ip_address: str,
+    opendkim_secret_id: str,
+) -> str:
+    """Opendkim signing for the test domain and smtp-relay relaying it to mailcatcher.
+
+    The tests using this fixture share a single wait for both applications to be active,
+    they must run before any test changing the opendkim configuration.
+
+    Returns:
+        The opendkim application name.
+    """
+    domain = DKIM_DOMAIN
+    selector = DKIM_SELECTOR
+    keyname = DKIM_KEYNAME
     keytable = [
         [f"{selector}._domainkey.{domain}", f"{domain}:{selector}:/etc/dkimkeys/{keyname}.private"]
     ]
     signingtable = [[f"*@{domain}", f"{selector}._domainkey.{domain}"]]
-    juju.config(
+    config_if_changed(
+        juju,
         opendkim_app,
         {
             "keytable": json.dumps(keytable),
             "signingtable": json.dumps(signingtable),
-            "private-keys": secret_id,
+            "private-keys": opendkim_secret_id,
         },
     )
 
+    status = juju.status()
+    unit = next(iter(status.apps[smtp_relay_app].units.values()))
     command_to_put_domain = f"echo {machine_ip_address} {domain} | sudo tee -a /etc/hosts"
     juju.exec(machine=int(unit.machine), command=command_to_put_domain)
 
-    juju.config(smtp_relay_app, {"relay_domains": f"- {domain}"})
     juju.wait(
         lambda status: jubilant.all_active(status, opendkim_app, smtp_relay_app),
         timeout=3 * 60,
         delay=5,
     )
+    return opendkim_app
+
+
+@pytest.mark.abort_on_fail
+def test_opendkim_signed_message(juju: jubilant.Juju, configured_opendkim, smtp_relay_app):
+    """
+    arrange: Deploy smtp-relay charm with the testrelay.internal domain in relay domains.
+    act: Send an email to an address with the testrelay.internal domain.
+    assert: The email is correctly relayed to the mailcatcher local test smtp server.
+    """
+    status = juju.status()
+    unit = next(iter(status.apps[smtp_relay_app].units.values()))
+    unit_ip = unit.public_address
+    domain = DKIM_DOMAIN
 
     mailcatcher_url = "http://127.0.0.1:1080/messages"
     messages = requests.get(mailcatcher_url, timeout=5).json()
@@ -121,20 +223,20 @@ def test_opendkim_signed_message(
 
     with smtplib.SMTP(unit_ip) as server:
         server.set_debuglevel(2)
-        from_addr = f"Some One <someone@{domain}>"
-        to_addrs = [f"otherone@{domain}"]
-        message = f"""\
-Subject: Hi Mailtrap
-To: {from_addr}
-From: {to_addrs[0]}
-This is my first message with Python."""
-        server.sendmail(from_addr=from_addr, to_addrs=to_addrs, msg=message)
-
-    for _ in range(5):
+        send_message(
+            server,
+            from_addr=f"Some One <someone@{domain}>",
+            to_addrs=[f"otherone@{domain}"],
+            subject="Hi Mailtrap",
+            body="This is my first message with Python.",
+        )
+
+    # Poll with an exponential backoff and jitter: the message usually arrives quickly.
+    for attempt in range(8):
         messages = requests.get(mailcatcher_url, timeout=5).json()
         if messages:
             break
-        time.sleep(1)
+        time.sleep(min(2.0, 0.05 * 2**attempt) * (1 + random.random() * 0.5))  # nosec B311
     assert len(messages) == 1
     message = requests.get(f"{mailcatcher_url}/{messages[0]['id']}.source", timeout=5).text
     logger.info("Message in mailcatcher: %s", message)
@@ -145,43 +247,52 @@ This is my first message with Python."""
 
 
 @pytest.mark.abort_on_fail
-def test_opendkim_testkey_failed_validation_(juju: jubilant.Juju, opendkim_app, smtp_relay_app):
+def test_metrics_configured(juju: jubilant.Juju, configured_opendkim):
+    """
+    arrange: Deploy opendkim.
+    act: Get the metrics from the unit.
+    assert: The metrics can be scraped and there are metrics.
+    """
+    status = juju.status()
+    unit = next(iter(status.apps[configured_opendkim].units.values()))
+    unit_ip = unit.public_address
+
+    metrics_output = requests.get(f"http://{unit_ip}:9103/metrics", timeout=5).text
+    # Some of the most important metrics used in the dashboard and alerts.
+    expected_metrics = [
+        "cpu_usage_idle",
+        "procstat_lookup_running",
+        "netstat_tcp_established",
+    ]
+    for expected_metric in expected_metrics:
+        assert expected_metric in metrics_output
+
+
+@pytest.mark.abort_on_fail
+def test_opendkim_testkey_failed_validation_(
+    juju: jubilant.Juju, opendkim_app, smtp_relay_app, opendkim_secret_id
+):
     """
     arrange: Deploy opendkim and smtp-relay.
     act: OpenDKIM configuration is invalid as a key file is missing.
     assert: The OpenDKIM charm is blocked and message says that the configuration is invalid.
     """
-    domain = "testrelay.internal"
-    selector = "default"
-    keyname = "testrelay-internal-default"
-    _, private_key = generate_opendkim_genkey(domain=domain, selector=selector)
-
-    try:
-        secret_id = juju.add_secret("opendkimsecret", {f"{keyname}": private_key})
-    except jubilant.CLIError as e:
-        secret_info = juju.show_secret("opendkimsecret")
-        secret_id = secret_info.uri
-        if "already exists" in e.stderr:
-            juju.update_secret(secret_id, {f"{keyname}": private_key})
-        else:
-            logger.error("Error adding secret %s %s", e.stderr, e.stdout)
-            raise e
-
-    juju.cli("grant-secret", secret_id, opendkim_app)
+    domain = DKIM_DOMAIN
+    selector = DKIM_SELECTOR
     keytable = [
         [f"{selector}._domainkey.{domain}", f"{domain}:{selector}:/etc/dkimkeys/WRONGNAME.private"]
     ]
     signingtable = [[f"*@{domain}", f"{selector}._domainkey.{domain}"]]
-    juju.config(
+    config_if_changed(
+        juju,
         opendkim_app,
         {
             "keytable": json.dumps(keytable),
             "signingtable": json.dumps(signingtable),
-            "private-keys": secret_id,
+            "private-keys": opendkim_secret_id,
         },
     )
 
-    juju.config(smtp_relay_app, {"relay_domains": f"- {domain}"})
     juju.wait(
         lambda status: (
             status.apps[smtp_relay_app].is_active and status.apps[opendkim_app].is_blocked
@@ -193,70 +304,9 @@ def test_opendkim_testkey_failed_validation_(juju: jubilant.Juju, opendkim_app,
     assert "Wrong opendkim configuration" in status.apps[opendkim_app].app_status.message
 
 
-@pytest.mark.abort_on_fail
-def test_metrics_configured(juju: jubilant.Juju, opendkim_app, smtp_relay_app, machine_ip_address):
-    """
-    arrange: Deploy opendkim.
-    act: Get the metrics from the unit.
-    assert: The metrics can be scraped and there are metrics.
-    """
-    status = juju.status()
-    unit = next(iter(status.apps[opendkim_app].units.values()))
-    unit_ip = unit.public_address
-
-    domain = "testrelay.internal"
-    selector = "default"
-    keyname = "testrelay-internal-default"
-    _, private_key = generate_opendkim_genkey(domain=domain, selector=selector)
-
-    try:
-        secret_id = juju.add_secret("opendkimsecret", {f"{keyname}": private_key})
-    except jubilant.CLIError as e:
-        secret_info = juju.show_secret("opendkimsecret")
-        secret_id = secret_info.uri
-        if "already exists" in e.stderr:
-            juju.update_secret(secret_id, {f"{keyname}": private_key})
-        else:
-            logger.error("Error adding secret %s %s", e.stderr, e.stdout)
-            raise e
-
-    juju.cli("grant-secret", secret_id, opendkim_app)
-    keytable = [
-        [f"{selector}._domainkey.{domain}", f"{domain}:{selector}:/etc/dkimkeys/{keyname}.private"]
-    ]
-    signingtable = [[f"*@{domain}", f"{selector}._domainkey.{domain}"]]
-    juju.config(
-        opendkim_app,
-        {
-            "keytable": json.dumps(keytable),
-            "signingtable": json.dumps(signingtable),
-            "private-keys": secret_id,
-        },
-    )
-
-    command_to_put_domain = f"echo {machine_ip_address} {domain} | sudo tee -a /etc/hosts"
-    juju.exec(machine=int(unit.machine), command=command_to_put_domain)
-
-    juju.config(smtp_relay_app, {"relay_domains": f"- {domain}"})
-    juju.wait(
-        lambda status: jubilant.all_active(status, opendkim_app, smtp_relay_app),
-        timeout=3 * 60,
-        delay=5,
-    )
-    metrics_output = requests.get(f"http://{unit_ip}:9103/metrics", timeout=5).text
-    # Some of the most important metrics used in the dashboard and alerts.
-    expected_metrics = [
-        "cpu_usage_idle",
-        "procstat_lookup_running",
-        "netstat_tcp_established",
-    ]
-    for expected_metric in expected_metrics:
-        assert expected_metric in metrics_output
-
-
 @pytest.mark.abort_on_fail
 def test_opendkim_verify_mode_with_trusted_sources(
-    juju: jubilant.Juju, opendkim_app, smtp_relay_app
+    juju: jubilant.Juju, opendkim_app, smtp_relay_app, opendkim_secret_id
 ):
     """
     arrange: Deploy opendkim with valid signing config and trusted-sources set.
@@ -264,40 +314,26 @@ def test_opendkim_verify_mode_with_trusted_sources(
     assert: The internalhosts file is written with the correct entries and opendkim.conf
         references it.
     """
-    domain = "testrelay.internal"
-    selector = "default"
-    keyname = "testrelay-internal-default"
-    _, private_key = generate_opendkim_genkey(domain=domain, selector=selector)
-
-    try:
-        secret_id = juju.add_secret("opendkimsecret", {f"{keyname}": private_key})
-    except jubilant.CLIError as e:
-        if "already exists" in e.stderr:
-            secret_info = juju.show_secret("opendkimsecret")
-            secret_id = secret_info.uri
-            juju.update_secret(secret_id, {f"{keyname}": private_key})
-        else:
-            logger.error("Error adding secret %s %s", e.stderr, e.stdout)
-            raise e
-
-    juju.cli("grant-secret", secret_id, opendkim_app)
+    domain = DKIM_DOMAIN
+    selector = DKIM_SELECTOR
+    keyname = DKIM_KEYNAME
     keytable = [
         [f"{selector}._domainkey.{domain}", f"{domain}:{selector}:/etc/dkimkeys/{keyname}.private"]
     ]
     signingtable = [[f"*@{domain}", f"{selector}._domainkey.{domain}"]]
     trusted_sources = "10.0.0.0/8, 192.168.1.0/24, 172.16.0.0/12"
-    juju.config(
+    config_if_changed(
+        juju,
         opendkim_app,
         {
             "keytable": json.dumps(keytable),
             "signingtable": json.dumps(signingtable),
-            "private-keys": secret_id,
+            "private-keys": opendkim_secret_id,
             "mode": "sv",
             "trusted-sources": trusted_sources,
         },
     )
 
-    juju.config(smtp_relay_app, {"relay_domains": f"- {domain}"})
     juju.wait(
         lambda status: jubilant.all_active(status, opendkim_app, smtp_relay_app),
         timeout=3 * 60,
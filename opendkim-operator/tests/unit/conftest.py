@@ -3,38 +3,60 @@
 
 """Fixtures for opendkim unit tests."""
 
-import copy
 import json
 import typing
-from secrets import token_hex
+from pathlib import Path
 
 import ops
 import ops.testing
 import pytest
 
+from charm import OpenDKIMCharm
 
-@pytest.fixture(scope="function", name="base_state")
-def base_state_fixture() -> dict[str, typing.Any]:
-    """Fixture for the base state for opendkim."""
-    secret_id = token_hex(20)[:20]
-    private_keys = {"key1": "PRIVATEKEY1", "key2": "PRIVATEKEY2"}
-    secrets = {ops.testing.Secret(id=f"secret:{secret_id}", tracked_content=private_keys)}
-
-    keytable = json.dumps(
+# ops.testing keeps each state apart, the secret ID does not need to be random.
+PRIVATE_KEYS_SECRET_ID = "secret:cpd8nb0j2k3e8ta0kolg"
+KEYTABLE = json.dumps(
+    [
+        ["selector._domainkey.example.com", "example.com:selector:/etc/dkimkeys/key1.private"],
         [
-            ["selector._domainkey.example.com", "example.com:selector:/etc/dkimkeys/key1.private"],
-            [
-                "selector._domainkey.other.example.com",
-                "other.example.com:selector:/etc/dkimkeys/key2.private",
-            ],
-        ]
-    )
-    signingtable = json.dumps(
-        [
-            ["*@example.com", "selector._domainkey.example.com"],
-            ["*@other.example.com", "selector._domainkey.other.example.com"],
-        ]
-    )
+            "selector._domainkey.other.example.com",
+            "other.example.com:selector:/etc/dkimkeys/key2.private",
+        ],
+    ]
+)
+SIGNINGTABLE = json.dumps(
+    [
+        ["*@example.com", "selector._domainkey.example.com"],
+        ["*@other.example.com", "selector._domainkey.other.example.com"],
+    ]
+)
+
+
+@pytest.fixture(scope="session", name="context")
+def context_fixture() -> ops.testing.Context:
+    """Fixture for the charm testing context, shared by all the tests.
+
+    Each run gets its state as an argument, only the recorded histories, which the tests
+    do not read, accumulate across runs.
+    """
+    return ops.testing.Context(charm_type=OpenDKIMCharm)
+
+
+@pytest.fixture(scope="session", name="expected_files")
+def expected_files_fixture() -> dict[str, str]:
+    """Fixture for the content of the files in tests/unit/files, read once per session."""
+    return {path.name: path.read_text() for path in (Path(__file__).parent / "files").iterdir()}
+
+
+@pytest.fixture(scope="session", name="base_state_template")
+def base_state_template_fixture() -> dict[str, typing.Any]:
+    """Fixture for the base state for opendkim, built once per test session."""
+    secrets = {
+        ops.testing.Secret(
+            id=PRIVATE_KEYS_SECRET_ID,
+            tracked_content={"key1": "PRIVATEKEY1", "key2": "PRIVATEKEY2"},
+        )
+    }
 
     milter_relation = ops.testing.Relation(
         id=1,
@@ -45,19 +67,30 @@ def base_state_fixture() -> dict[str, typing.Any]:
     )
     return {
         "config": {
-            "keytable": keytable,
-            "signingtable": signingtable,
-            "private-keys": f"secret:{secret_id}",
+            "keytable": KEYTABLE,
+            "signingtable": SIGNINGTABLE,
+            "private-keys": PRIVATE_KEYS_SECRET_ID,
         },
         "secrets": secrets,
         "relations": [milter_relation],
     }
 
 
+@pytest.fixture(scope="function", name="base_state")
+def base_state_fixture(base_state_template: dict[str, typing.Any]) -> dict[str, typing.Any]:
+    """Fixture for the base state for opendkim.
+
+    The secrets and relations are shared between tests: ops.testing never mutates them.
+    """
+    return {**base_state_template, "config": dict(base_state_template["config"])}
+
+
 @pytest.fixture(scope="function", name="trusted_sources_state")
 def trusted_sources_state_fixture(base_state: dict[str, typing.Any]) -> dict[str, typing.Any]:
     """Fixture for state with trusted-sources configured."""
-    state = copy.deepcopy(base_state)
-    state["config"]["trusted-sources"] = "10.0.0.0/8, 192.168.1.0/24"
-    state["config"]["mode"] = "sv"
-    return state
+    config = {
+        **base_state["config"],
+        "trusted-sources": "10.0.0.0/8, 192.168.1.0/24",
+        "mode": "sv",
+    }
+    return {**base_state, "config": config}
@@ -3,14 +3,14 @@
 
 """Unit tests."""
 
+import dataclasses
 import getpass
 import json
 import os
 import subprocess  # nosec B404
-import tempfile
 import typing
 from pathlib import Path
-from secrets import token_hex
+from types import SimpleNamespace
 from unittest.mock import ANY, MagicMock, call
 
 import ops.testing
@@ -18,41 +18,73 @@ import pytest
 
 import charm
 import utils
-from charm import OpenDKIMCharm
+from state import InvalidCharmConfigError
 
+# ops.testing keeps each state apart, the secret ID does not need to be random.
+PRIVATE_KEYS_SECRET_ID = "secret:cpd8nb0j2k3e8ta0kolg"
 
-def test_install(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+
+class Recorder:
+    """Callable stub recording its calls, lighter than a MagicMock for plain functions."""
+
+    __slots__ = ("calls", "return_value")
+
+    def __init__(self, return_value: typing.Any = None):
+        self.calls: list[tuple[tuple, dict]] = []
+        self.return_value = return_value
+
+    def __call__(self, *args, **kwargs):
+        self.calls.append((args, kwargs))
+        return self.return_value
+
+    def assert_any_call(self, *args, **kwargs):
+        assert (args, kwargs) in self.calls, f"{args} {kwargs} not in {self.calls}"
+
+    def assert_not_called(self):
+        assert not self.calls, f"Unexpected calls: {self.calls}"
+
+    def reset_mock(self):
+        self.calls.clear()
+
+
+@pytest.mark.parametrize(
+    "snaps_present,conf_updated",
+    [
+        pytest.param(False, True, id="Snaps not installed"),
+        pytest.param(True, True, id="Snaps installed, telegraf configuration changed"),
+        pytest.param(True, False, id="Snaps installed, telegraf configuration unchanged"),
+    ],
+)
+def test_install(
+    snaps_present: bool,
+    conf_updated: bool,
+    context: ops.testing.Context,
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+):
     """
-    arrange: Mock snap installs and prepare a trivial context and state.
+    arrange: Mock the snap cache and prepare a trivial context and state.
     act: Run install hook.
-    assert: OpenDKIM and Telegraf snaps were installed and the unit is waiting.
+    assert: Missing snaps are installed, telegraf is only restarted when installed or
+        reconfigured, and the unit is waiting.
     """
-    # Mock subprocess.run to simulate snap not present
-    subprocess_run_mock = MagicMock()
-    subprocess_run_mock.returncode = 1
-    monkeypatch.setattr(subprocess, "run", subprocess_run_mock)
-
-    # Mock SnapCache for opendkim snap
     opendkim_snap_mock = MagicMock()
-    opendkim_snap_mock.present = False
+    opendkim_snap_mock.present = snaps_present
+    telegraf_snap_mock = MagicMock()
+    telegraf_snap_mock.present = snaps_present
+    snaps = {"opendkim": opendkim_snap_mock, "telegraf": telegraf_snap_mock}
     snap_cache_mock = MagicMock()
-    snap_cache_mock.__getitem__.return_value = opendkim_snap_mock
+    snap_cache_mock.__getitem__.side_effect = snaps.__getitem__
     monkeypatch.setattr("charm.snap.SnapCache", MagicMock(return_value=snap_cache_mock))
 
-    telegraf_snap_mock = MagicMock()
-    snap_add_mock = MagicMock(return_value=telegraf_snap_mock)
-    monkeypatch.setattr(charm.snap, "add", snap_add_mock)
     telegraf_conf = tmp_path / "telegraf.conf"
     monkeypatch.setattr(charm, "TELEGRAF_CONF_DST", telegraf_conf)
 
-    write_file_mock = MagicMock()
+    write_file_mock = MagicMock(return_value=conf_updated)
     monkeypatch.setattr("utils.write_file", write_file_mock)
-    update_logrotate_conf_mock = MagicMock()
+    update_logrotate_conf_mock = Recorder()
     monkeypatch.setattr("utils.update_logrotate_conf", update_logrotate_conf_mock)
 
-    context = ops.testing.Context(
-        charm_type=OpenDKIMCharm,
-    )
     base_state: dict[str, str] = {}
     state = ops.testing.State(**base_state)
     out = context.run(context.on.install(), state)
@@ -62,12 +94,12 @@ def test_install(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
     assert out.unit_status.name == ops.testing.WaitingStatus.name
 
     # Telegraf configuration
-    snap_add_mock.assert_called_once_with(["telegraf"])
     write_file_mock.assert_has_calls([call(telegraf_conf, ANY, 0o644, user="root")])
-    telegraf_snap_mock.restart.assert_called_once()
+    assert telegraf_snap_mock.ensure.called is not snaps_present
+    assert telegraf_snap_mock.restart.called is (not snaps_present or conf_updated)
 
     # OpenDKIM snap installation from store
-    opendkim_snap_mock.ensure.assert_called_once()
+    assert opendkim_snap_mock.ensure.called is not snaps_present
 
 
 @pytest.mark.parametrize(
@@ -117,16 +149,12 @@ def test_install(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
         ),
     ],
 )
-def test_invalid_config(signingtable, keytable, private_keys, error_messages):
+def test_invalid_config(signingtable, keytable, private_keys, error_messages, context):
     """
     arrange: Prepare a configuration options and key secrets that is invalid.
     act: Send hook on config_changed.
     assert: Test that the charm is blocked and the correct message is shown..
     """
-    context = ops.testing.Context(
-        charm_type=OpenDKIMCharm,
-    )
-
     config: dict[str, str] = {}
     secrets: ops.testing.Secret = {}
     if signingtable is not None:
@@ -134,9 +162,8 @@ def test_invalid_config(signingtable, keytable, private_keys, error_messages):
     if keytable is not None:
         config["keytable"] = keytable
     if private_keys is not None:
-        secret_id = token_hex(20)[:20]
-        config["private-keys"] = f"secret:{secret_id}"
-        secrets = {ops.testing.Secret(id=f"secret:{secret_id}", tracked_content=private_keys)}
+        config["private-keys"] = PRIVATE_KEYS_SECRET_ID
+        secrets = {ops.testing.Secret(id=PRIVATE_KEYS_SECRET_ID, tracked_content=private_keys)}
     base_state: dict[str, typing.Any] = {"config": config, "secrets": secrets}
     state = ops.testing.State(**base_state)
     out = context.run(context.on.config_changed(), state)
@@ -145,19 +172,14 @@ def test_invalid_config(signingtable, keytable, private_keys, error_messages):
         assert error_message in out.unit_status.message
 
 
-def test_missing_milter_relation():
+def test_missing_milter_relation(context):
     """
     arrange: Prepare a valid configuration and apply it.
     act: Send hook on config_changed.
     assert: The charmed is blocked because there is no valid milter relation.
     """
-    context = ops.testing.Context(
-        charm_type=OpenDKIMCharm,
-    )
-
-    secret_id = token_hex(20)[:20]
     secrets = {
-        ops.testing.Secret(id=f"secret:{secret_id}", tracked_content={"thekey": "PRIVATEKEY"})
+        ops.testing.Secret(id=PRIVATE_KEYS_SECRET_ID, tracked_content={"thekey": "PRIVATEKEY"})
     }
     config = {
         "signingtable": json.dumps([["*@example.com", "selector._domainkey.example.com"]]),
@@ -169,7 +191,7 @@ def test_missing_milter_relation():
                 ]
             ]
         ),
-        "private-keys": f"secret:{secret_id}",
+        "private-keys": PRIVATE_KEYS_SECRET_ID,
     }
     base_state: dict[str, typing.Any] = {"config": config, "secrets": secrets}
     state = ops.testing.State(**base_state)
@@ -179,58 +201,43 @@ def test_missing_milter_relation():
 
 
 @pytest.mark.parametrize(
-    "initial_opendkim_conf,restart_expected",
+    "restart_expected",
     [
-        pytest.param("", True, id="Initial opendkim.conf empty, restart service"),
-        pytest.param(
-            (Path(__file__).parent / "files/base_opendkim.conf").read_text(),
-            False,
-            id="opendkim.conf not changed, do not restart service",
-        ),
+        pytest.param(True, id="Initial files missing, restart service"),
+        pytest.param(False, id="Files not changed, do not restart service"),
     ],
 )
 def test_correct_config(
-    initial_opendkim_conf, restart_expected, base_state, tmp_path: Path, monkeypatch
+    restart_expected, base_state, expected_files, context, tmp_path: Path, monkeypatch
 ):
     """
     arrange: Mock all external accesses and prepare a valid configuration with a milter relation.
     act: Run install hook, then config_changed hook.
     assert: The charm is active. Files are written and the service is restarted/reloaded via snap.
     """
-    if restart_expected:
-        read_text_mock = MagicMock(return_value="")
-    else:
-        signingtable_content = (Path(__file__).parent / "files/base_signingtable").read_text()
-        keytable_content = (Path(__file__).parent / "files/base_keytable").read_text()
-
-        def read_text_side_effect(path):
-            name = Path(path).name
-            match name:
-                case "key1.private":
-                    return "PRIVATEKEY1"
-                case "key2.private":
-                    return "PRIVATEKEY2"
-                case "signingtable":
-                    return signingtable_content
-                case "keytable":
-                    return keytable_content
-                case "opendkim.conf":
-                    return initial_opendkim_conf
-                case _:
-                    return ""
-
-        read_text_mock = MagicMock(side_effect=read_text_side_effect)
-
-    monkeypatch.setattr("utils.read_text", read_text_mock)
-    monkeypatch.setattr("charm.validate_opendkim", MagicMock(return_value=None))
-    subprocess_run_mock = MagicMock(return_value=MagicMock(stdout="LISTEN"))
+    existing_content: dict[str, str] = {}
+    if not restart_expected:
+        existing_content = {
+            "key1.private": "PRIVATEKEY1",
+            "key2.private": "PRIVATEKEY2",
+            "signingtable": expected_files["base_signingtable"],
+            "keytable": expected_files["base_keytable"],
+            "opendkim.conf": expected_files["base_opendkim.conf"],
+        }
+
+    monkeypatch.setattr("charm.validate_opendkim", Recorder())
+    subprocess_run_mock = Recorder(SimpleNamespace(stdout="LISTEN"))
     monkeypatch.setattr("charm.subprocess.run", subprocess_run_mock)
     write_calls = []
 
-    def write_file_mock(path, content, mode, user=None):
+    def write_file_mock(path, content, mode, user=None, sync_dir=True):
+        if existing_content.get(Path(path).name) == content:
+            return False
         write_calls.append((path, content, mode, user))
+        return True
 
     monkeypatch.setattr("utils.write_file", write_file_mock)
+    monkeypatch.setattr("utils.fsync_dir", Recorder())
 
     opendkim_snap_mock = MagicMock()
     telegraf_snap_mock = MagicMock()
@@ -238,16 +245,12 @@ def test_correct_config(
     telegraf_conf = tmp_path / "telegraf.conf"
     monkeypatch.setattr(charm, "TELEGRAF_CONF_DST", telegraf_conf)
 
-    monkeypatch.setattr("charm.Path.exists", MagicMock(return_value=True))
+    monkeypatch.setattr("charm.Path.exists", Recorder(True))
 
     snap_cache_mock = MagicMock()
     snap_cache_mock.__getitem__ = MagicMock(return_value=opendkim_snap_mock)
     monkeypatch.setattr("charm.snap.SnapCache", MagicMock(return_value=snap_cache_mock))
 
-    context = ops.testing.Context(
-        charm_type=OpenDKIMCharm,
-    )
-
     state = ops.testing.State(**base_state)
     out = context.run(context.on.config_changed(), state)
 
@@ -268,17 +271,141 @@ def test_correct_config(
         opendkim_snap_mock.restart.assert_not_called()
 
 
-def test_write_file():
+def test_changed_key_reloads_service(base_state, context, monkeypatch):
+    """
+    arrange: Mock all external accesses so that only one private key differs on disk.
+    act: Run the config_changed hook.
+    assert: Only the key file is written and the service is reloaded, not restarted.
+    """
+    write_file_mock = MagicMock(side_effect=lambda path, *_, **__: path.name == "key1.private")
+    monkeypatch.setattr("utils.write_file", write_file_mock)
+    monkeypatch.setattr("utils.fsync_dir", Recorder())
+    monkeypatch.setattr("charm.validate_opendkim", Recorder())
+    monkeypatch.setattr("charm.subprocess.run", Recorder(SimpleNamespace(stdout="LISTEN")))
+    monkeypatch.setattr("charm.Path.exists", Recorder(True))
+    opendkim_snap_mock = MagicMock()
+    snap_cache_mock = MagicMock()
+    snap_cache_mock.__getitem__ = MagicMock(return_value=opendkim_snap_mock)
+    monkeypatch.setattr("charm.snap.SnapCache", MagicMock(return_value=snap_cache_mock))
+
+    out = context.run(context.on.config_changed(), ops.testing.State(**base_state))
+
+    assert out.unit_status.name == ops.testing.ActiveStatus.name
+    write_file_mock.assert_any_call(
+        Path("/var/snap/opendkim/current/etc/dkimkeys/key1.private"),
+        "PRIVATEKEY1",
+        0o600,
+        user="opendkim",
+        sync_dir=False,
+    )
+    opendkim_snap_mock.restart.assert_called_once_with(reload=True)
+
+
+def test_unchanged_config_skips_reconcile(base_state, context, monkeypatch):
+    """
+    arrange: Mock all external accesses and reconcile a valid configuration once.
+    act: Run the config_changed hook again with the same configuration.
+    assert: The charm stays active without writing files, restarting or revalidating.
+    """
+    write_file_mock = Recorder(True)
+    monkeypatch.setattr("utils.write_file", write_file_mock)
+    monkeypatch.setattr("utils.fsync_dir", Recorder())
+    validate_opendkim_mock = Recorder()
+    monkeypatch.setattr("charm.validate_opendkim", validate_opendkim_mock)
+    monkeypatch.setattr("charm.subprocess.run", Recorder(SimpleNamespace(stdout="LISTEN")))
+    monkeypatch.setattr("charm.Path.exists", Recorder(True))
+    opendkim_snap_mock = MagicMock()
+    snap_cache_mock = MagicMock()
+    snap_cache_mock.__getitem__ = MagicMock(return_value=opendkim_snap_mock)
+    monkeypatch.setattr("charm.snap.SnapCache", MagicMock(return_value=snap_cache_mock))
+
+    out = context.run(context.on.config_changed(), ops.testing.State(**base_state))
+    assert out.unit_status.name == ops.testing.ActiveStatus.name
+    write_file_mock.reset_mock()
+    opendkim_snap_mock.reset_mock()
+    validate_opendkim_mock.reset_mock()
+
+    out = context.run(context.on.config_changed(), out)
+
+    assert out.unit_status.name == ops.testing.ActiveStatus.name
+    write_file_mock.assert_not_called()
+    opendkim_snap_mock.restart.assert_not_called()
+    validate_opendkim_mock.assert_not_called()
+
+
+def test_secret_refreshed_only_on_secret_changed(base_state, context, monkeypatch):
+    """
+    arrange: Mock all external accesses and publish a new revision of the private keys secret.
+    act: Run the config_changed hook, then the secret_changed hook.
+    assert: The tracked keys are written on config_changed and the new ones on secret_changed.
+    """
+    write_file_mock = Recorder(True)
+    monkeypatch.setattr("utils.write_file", write_file_mock)
+    monkeypatch.setattr("utils.fsync_dir", Recorder())
+    monkeypatch.setattr("charm.validate_opendkim", Recorder())
+    monkeypatch.setattr("charm.subprocess.run", Recorder(SimpleNamespace(stdout="LISTEN")))
+    monkeypatch.setattr("charm.Path.exists", Recorder(True))
+    snap_cache_mock = MagicMock()
+    snap_cache_mock.__getitem__ = MagicMock(return_value=MagicMock())
+    monkeypatch.setattr("charm.snap.SnapCache", MagicMock(return_value=snap_cache_mock))
+    secret = next(iter(base_state["secrets"]))
+    secret = dataclasses.replace(
+        secret, latest_content={"key1": "NEWPRIVATEKEY1", "key2": "PRIVATEKEY2"}
+    )
+    key1_path = Path("/var/snap/opendkim/current/etc/dkimkeys/key1.private")
+
+    state = ops.testing.State(**{**base_state, "secrets": {secret}})
+    out = context.run(context.on.config_changed(), state)
+
+    assert out.unit_status.name == ops.testing.ActiveStatus.name
+    write_file_mock.assert_any_call(
+        key1_path, "PRIVATEKEY1", 0o600, user="opendkim", sync_dir=False
+    )
+    write_file_mock.reset_mock()
+
+    out = context.run(context.on.secret_changed(secret), out)
+
+    assert out.unit_status.name == ops.testing.ActiveStatus.name
+    write_file_mock.assert_any_call(
+        key1_path, "NEWPRIVATEKEY1", 0o600, user="opendkim", sync_dir=False
+    )
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        pytest.param(subprocess.CalledProcessError(1, "opendkim.testkey"), id="Failed"),
+        pytest.param(subprocess.TimeoutExpired("opendkim.testkey", 30), id="Timed out"),
+    ],
+)
+def test_validate_opendkim_error(error, monkeypatch):
+    """
+    arrange: Mock opendkim.testkey to fail or to time out.
+    act: Call validate_opendkim.
+    assert: An InvalidCharmConfigError is raised.
+    """
+    monkeypatch.setattr("charm.subprocess.run", MagicMock(side_effect=error))
+
+    with pytest.raises(InvalidCharmConfigError, match="Wrong opendkim configuration"):
+        charm.validate_opendkim()
+
+
+def test_write_file(tmp_path: Path):
     """
     arrange: Prepare some text and a directory.
     act: Call write_file.
     assert: The file is rendered with the correct content.
     """
     user = getpass.getuser()
-    with tempfile.TemporaryDirectory() as tmpdir:
-        content = "any text"
-        path = Path(tmpdir) / "onefile.txt"
-        utils.write_file(path, content, 0o666, user=user)
-        st = os.stat(str(path))
-        assert oct(st.st_mode) == "0o100666"
-        assert path.read_text() == content
+    content = "any text"
+    path = tmp_path / "onefile.txt"
+    assert utils.write_file(path, content, 0o666, user=user)
+    st = os.stat(str(path))
+    assert oct(st.st_mode) == "0o100666"
+    assert path.read_text() == content
+    assert list(tmp_path.iterdir()) == [path]
+    assert not utils.write_file(path, content, 0o666, user=user)
+    os.chmod(path, 0o600)
+    assert not utils.write_file(path, content, 0o666, user=user)
+    assert oct(os.stat(str(path)).st_mode) == "0o100666"
+    assert utils.write_file(path, content, 0o666, user=user, only_if_changed=False)
@@ -3,14 +3,48 @@
 
 """Unit tests for utils."""
 
+import getpass
+import typing
+from pathlib import Path
+from unittest.mock import MagicMock
+
+import pytest
+
 import utils
 
 
-def test_logrotate_frequency():
-    """Test log rotate frequency is updated."""
-    with open("tests/unit/files/logrotate_frequency", encoding="utf-8") as f:
-        want = f.read()
-    assert utils.update_logrotate_conf("tests/unit/files/logrotate", frequency="daily") == want
+@pytest.mark.parametrize(
+    "input_name,kwargs,expected_name",
+    [
+        pytest.param(
+            "logrotate", {"frequency": "daily"}, "logrotate_frequency", id="Frequency updated"
+        ),
+        pytest.param(
+            "logrotate", {"retention": 30}, "logrotate_retention", id="Retention updated"
+        ),
+        pytest.param(
+            "logrotate",
+            {"retention": 30, "dateext": False},
+            "logrotate_retention_no_dateext",
+            id="Retention updated without dateext",
+        ),
+        pytest.param(
+            "logrotate_retention",
+            {"retention": 30, "dateext": False},
+            "logrotate_retention_no_dateext",
+            id="Retention updated, dateext removed",
+        ),
+    ],
+)
+def test_logrotate(
+    input_name: str,
+    kwargs: dict[str, typing.Any],
+    expected_name: str,
+    expected_files: dict[str, str],
+):
+    """Test log rotate frequency and retention are correctly updated."""
+    path = Path("tests/unit/files") / input_name
+    assert utils.update_logrotate_conf(path, **kwargs) == expected_files[expected_name]
 
 
 def test_logrotate_non_exists():
@@ -23,27 +57,37 @@ def test_logrotate_non_exists():
     )
 
 
-def test_logrotate_retention():
-    """Test update log rotate retention is correctly updated."""
-    with open("tests/unit/files/logrotate_retention", encoding="utf-8") as f:
-        want = f.read()
-    assert utils.update_logrotate_conf("tests/unit/files/logrotate", retention=30) == want
+def test_file_matches(tmp_path: Path):
+    """Test file_matches compares the file content with the given content."""
+    path = tmp_path / "onefile.txt"
+    assert not utils.file_matches(path, "any text")
 
+    path.write_text("any text", encoding="utf-8")
+    assert utils.file_matches(path, "any text")
+    assert utils.file_matches(path, b"any text")
+    assert not utils.file_matches(path, "any txet")
+    assert not utils.file_matches(path, "other text")
 
-def test_logrotate_retention_no_dateext():
-    """Test update log rotate retention without dateext."""
-    with open("tests/unit/files/logrotate_retention_no_dateext", encoding="utf-8") as f:
-        want = f.read()
-    assert (
-        utils.update_logrotate_conf("tests/unit/files/logrotate", retention=30, dateext=False)
-        == want
-    )
 
-    with open("tests/unit/files/logrotate_retention_no_dateext", encoding="utf-8") as f:
-        want = f.read()
-    assert (
-        utils.update_logrotate_conf(
-            "tests/unit/files/logrotate_retention", retention=30, dateext=False
-        )
-        == want
-    )
+def test_write_files(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    """Test write_files writes changed files and syncs their directory once."""
+    fsync_dir_mock = MagicMock()
+    monkeypatch.setattr(utils, "fsync_dir", fsync_dir_mock)
+    user = getpass.getuser()
+    files = [(tmp_path / "one", "one text", 0o600), (tmp_path / "two", b"two text", 0o644)]
+
+    assert utils.write_files(files, user=user)
+    assert (tmp_path / "one").read_text() == "one text"
+    assert (tmp_path / "two").read_text() == "two text"
+    fsync_dir_mock.assert_called_once_with(tmp_path)
+
+    fsync_dir_mock.reset_mock()
+    assert not utils.write_files(files, user=user)
+    fsync_dir_mock.assert_not_called()
+
+
+def test_fsync_dir(tmp_path: Path):
+    """Test fsync_dir syncs an existing directory and fails on a missing one."""
+    utils.fsync_dir(tmp_path)
+    with pytest.raises(FileNotFoundError):
+        utils.fsync_dir(tmp_path / "missing")